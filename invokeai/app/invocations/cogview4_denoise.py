@@ -1,4 +1,8 @@
-from typing import Callable, Optional
+import functools
+import importlib.util
+import math
+from contextlib import contextmanager
+from typing import Any, Callable, ClassVar, Generator, Optional
 
 import torch
 import torchvision.transforms as tv_transforms
@@ -29,12 +33,49 @@ from invokeai.backend.stable_diffusion.diffusion.conditioning_data import CogVie
 from invokeai.backend.util.devices import TorchDevice
 
 
+def _cfg_euler_step(
+    latents: torch.Tensor,
+    noise_pred_uncond: torch.Tensor,
+    noise_pred_cond: torch.Tensor,
+    cfg_scale: torch.Tensor | float,
+    dt: torch.Tensor | float,
+) -> torch.Tensor:
+    """Apply CFG to the noise predictions and take a single Euler step from the current latents."""
+    noise_pred = noise_pred_uncond + cfg_scale * (noise_pred_cond - noise_pred_uncond)
+    # The Euler update is a single add, so we keep it in the latents dtype (as we do for FLUX) rather than round-tripping
+    # through float32.
+    return latents + dt * noise_pred
+
+
+@contextmanager
+def _allow_tf32(device: torch.device) -> Generator[None, None, None]:
+    """Allow TF32 for float32 matmuls and convolutions for the duration of the context. The global backend flags are
+    restored on exit.
+
+    The transformer runs in bfloat16 and TF32 only applies to float32 matmuls/convolutions, so this has little to no
+    effect on the transformer itself. This is a no-op on non-CUDA devices.
+    """
+    if device.type != "cuda":
+        yield
+        return
+
+    prev_matmul_allow_tf32 = torch.backends.cuda.matmul.allow_tf32
+    prev_cudnn_allow_tf32 = torch.backends.cudnn.allow_tf32
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    try:
+        yield
+    finally:
+        torch.backends.cuda.matmul.allow_tf32 = prev_matmul_allow_tf32
+        torch.backends.cudnn.allow_tf32 = prev_cudnn_allow_tf32
+
+
 @invocation(
     "cogview4_denoise",
     title="Denoise - CogView4",
     tags=["image", "cogview4"],
     category="image",
-    version="1.0.0",
+    version="1.1.0",
     classification=Classification.Prototype,
 )
 class CogView4DenoiseInvocation(BaseInvocation, WithMetadata, WithBoard):
@@ -64,6 +105,18 @@ class CogView4DenoiseInvocation(BaseInvocation, WithMetadata, WithBoard):
     height: int = InputField(default=1024, multiple_of=32, description="Height of the generated image.")
     steps: int = InputField(default=25, gt=0, description=FieldDescriptions.steps)
     seed: int = InputField(default=0, description="Randomness seed for reproducibility.")
+    compile_transformer: bool = InputField(
+        default=False,
+        description="Compile the transformer with torch.compile (CUDA with Triton only). The model is compiled again "
+        "for each new resolution and for each CFG mode (batched or sequential), so the first run of each is slow. "
+        "Subsequent runs are faster.",
+    )
+
+    # The compiled transformer forward is shared by all instances of this invocation so that the (expensive)
+    # compilation is amortized across invocations. It compiles the unbound forward method, so it does not hold a
+    # reference to any particular model and does not prevent the model cache from releasing it.
+    _compiled_transformer_forward: ClassVar[Callable[..., Any] | None] = None
+    _compiled_cfg_euler_step: ClassVar[Callable[..., torch.Tensor] | None] = None
 
     @torch.no_grad()
     def invoke(self, context: InvocationContext) -> LatentsOutput:
@@ -73,6 +126,37 @@ class CogView4DenoiseInvocation(BaseInvocation, WithMetadata, WithBoard):
         name = context.tensors.save(tensor=latents)
         return LatentsOutput.build(latents_name=name, latents=latents, seed=None)
 
+    @classmethod
+    def _get_compiled_transformer_forward(cls) -> Callable[..., Any]:
+        """Get the compiled CogView4 transformer forward, compiling it on first use.
+
+        The compiled function is cached on the class, so repeated invocations reuse the compiled artifacts rather than
+        recompiling.
+        """
+        if cls._compiled_transformer_forward is None:
+            # Dynamo compiles a separate graph for each combination of resolution, CFG batch size and transformer
+            # instance. Raise the recompile limit so that switching between a handful of these does not cause dynamo
+            # to give up and fall back to eager mode.
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 128)
+            # Shapes are constant across steps, so we can disable dynamic shapes. We intentionally do not use CUDA
+            # graphs (mode="reduce-overhead"): they keep the activations in a private memory pool that outlives the
+            # invocation and is invisible to the model cache's VRAM accounting, and the model cache can move the
+            # transformer weights between invocations, which invalidates the recorded graphs.
+            cls._compiled_transformer_forward = torch.compile(CogView4Transformer2DModel.forward, dynamic=False)
+        return cls._compiled_transformer_forward
+
+    @classmethod
+    def _get_compiled_cfg_euler_step(cls) -> Callable[..., torch.Tensor]:
+        """Get the compiled `_cfg_euler_step`, compiling it on first use.
+
+        When compiled, the CFG combine and the Euler update are fused into a single kernel, so the full-size latent
+        tensors are read and written once per step rather than once per elementwise op. cfg_scale and dt are passed as
+        0-dim device tensors to avoid recompiling for every distinct value.
+        """
+        if cls._compiled_cfg_euler_step is None:
+            cls._compiled_cfg_euler_step = torch.compile(_cfg_euler_step, fullgraph=True, dynamic=False)
+        return cls._compiled_cfg_euler_step
+
     def _prep_inpaint_mask(self, context: InvocationContext, latents: torch.Tensor) -> torch.Tensor | None:
         """Prepare the inpaint mask.
         - Loads the mask
@@ -108,22 +192,43 @@ class CogView4DenoiseInvocation(BaseInvocation, WithMetadata, WithBoard):
         mask = mask.to(device=latents.device, dtype=latents.dtype)
         return mask
 
-    def _load_text_conditioning(
-        self,
-        context: InvocationContext,
-        conditioning_name: str,
-        dtype: torch.dtype,
-        device: torch.device,
-    ) -> torch.Tensor:
+    def _load_text_conditioning(self, context: InvocationContext, conditioning_name: str) -> torch.Tensor:
         # Load the conditioning data.
         cond_data = context.conditioning.load(conditioning_name)
         assert len(cond_data.conditionings) == 1
         cogview4_conditioning = cond_data.conditionings[0]
         assert isinstance(cogview4_conditioning, CogView4ConditioningInfo)
-        cogview4_conditioning = cogview4_conditioning.to(dtype=dtype, device=device)
 
         return cogview4_conditioning.glm_embeds
 
+    def _load_text_conditionings(
+        self,
+        context: InvocationContext,
+        dtype: torch.dtype,
+        device: torch.device,
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor | None]:
+        """Load the positive and negative text conditionings and move them to the target device and dtype.
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor, torch.Tensor | None]: The positive embeddings, the negative embeddings and,
+                if the two have the same shape, the [negative, positive] batch of embeddings. In that case, the
+                embeddings are moved to the device in a single transfer and the positive and negative embeddings are
+                views into the batch.
+        """
+        pos_glm_embeds = self._load_text_conditioning(context, self.positive_conditioning.conditioning_name)
+        neg_glm_embeds = self._load_text_conditioning(context, self.negative_conditioning.conditioning_name)
+
+        if pos_glm_embeds.shape != neg_glm_embeds.shape:
+            return (
+                pos_glm_embeds.to(device=device, dtype=dtype),
+                neg_glm_embeds.to(device=device, dtype=dtype),
+                None,
+            )
+
+        prompt_embeds = torch.cat([neg_glm_embeds, pos_glm_embeds], dim=0).to(device=device, dtype=dtype)
+        neg_prompt_embeds, pos_prompt_embeds = prompt_embeds.chunk(2)
+        return pos_prompt_embeds, neg_prompt_embeds, prompt_embeds
+
     def _get_noise(
         self,
         batch_size: int,
@@ -138,15 +243,22 @@ class CogView4DenoiseInvocation(BaseInvocation, WithMetadata, WithBoard):
         rand_device = "cpu"
         rand_dtype = torch.float16
 
-        return torch.randn(
+        shape = (
             batch_size,
             num_channels_latents,
             int(height) // LATENT_SCALE_FACTOR,
             int(width) // LATENT_SCALE_FACTOR,
-            device=rand_device,
-            dtype=rand_dtype,
-            generator=torch.Generator(device=rand_device).manual_seed(seed),
-        ).to(device=device, dtype=dtype)
+        )
+        # Generate the noise into pinned memory so that the transfer to the device does not block the host. This lets
+        # the copy overlap with loading the transformer onto the device.
+        use_pinned_memory = device.type == "cuda"
+        noise = torch.empty(shape, device=rand_device, dtype=rand_dtype, pin_memory=use_pinned_memory)
+        torch.randn(shape, generator=torch.Generator(device=rand_device).manual_seed(seed), out=noise)
+        # Copy without changing dtype and cast on the device. A combined device + dtype conversion would cast into a
+        # pageable CPU temporary first, and the transfer would no longer come from the pinned buffer.
+        # The copy is only non-blocking from pinned memory. An async copy from pageable memory (e.g. on MPS) could read
+        # the buffer after it has been freed.
+        return noise.to(device=device, non_blocking=use_pinned_memory).to(dtype=dtype)
 
     def _prepare_cfg_scale(self, num_timesteps: int) -> list[float]:
         """Prepare the CFG scale list.
@@ -203,25 +315,30 @@ class CogView4DenoiseInvocation(BaseInvocation, WithMetadata, WithBoard):
         # Load/process the conditioning data.
         # TODO(ryand): Make CFG optional.
         do_classifier_free_guidance = True
-        pos_prompt_embeds = self._load_text_conditioning(
-            context=context,
-            conditioning_name=self.positive_conditioning.conditioning_name,
-            dtype=inference_dtype,
-            device=device,
+        pos_prompt_embeds, neg_prompt_embeds, prompt_embeds = self._load_text_conditionings(
+            context=context, dtype=inference_dtype, device=device
         )
-        neg_prompt_embeds = self._load_text_conditioning(
-            context=context,
-            conditioning_name=self.negative_conditioning.conditioning_name,
-            dtype=inference_dtype,
-            device=device,
+
+        # The positive and negative prompts are padded independently (to a multiple of 16 tokens), so they can only be
+        # run through the transformer in a single batch if their sequence lengths match. In practice, they often don't
+        # (e.g. with an empty negative prompt), in which case we fall back to sequential CFG.
+        # Batched CFG roughly doubles the activation memory of each transformer pass. Users who run out of memory can
+        # disable it with the `sequential_guidance` config setting.
+        batched_cfg = (
+            do_classifier_free_guidance and not context.config.get().sequential_guidance and prompt_embeds is not None
         )
+        cfg_batch_size = 2 if batched_cfg else 1
 
         # Prepare misc. conditioning variables.
         # TODO(ryand): We could expose these as params (like with SDXL). But, we should experiment to see if they are
         # useful first.
-        original_size = torch.tensor([(self.height, self.width)], dtype=pos_prompt_embeds.dtype, device=device)
-        target_size = torch.tensor([(self.height, self.width)], dtype=pos_prompt_embeds.dtype, device=device)
-        crops_coords_top_left = torch.tensor([(0, 0)], dtype=pos_prompt_embeds.dtype, device=device)
+        original_size = torch.tensor(
+            [(self.height, self.width)] * cfg_batch_size, dtype=pos_prompt_embeds.dtype, device=device
+        )
+        target_size = torch.tensor(
+            [(self.height, self.width)] * cfg_batch_size, dtype=pos_prompt_embeds.dtype, device=device
+        )
+        crops_coords_top_left = torch.tensor([(0, 0)] * cfg_batch_size, dtype=pos_prompt_embeds.dtype, device=device)
 
         # Prepare the timestep / sigma schedule.
         patch_size = transformer_info.model.config.patch_size  # type: ignore
@@ -234,8 +351,16 @@ class CogView4DenoiseInvocation(BaseInvocation, WithMetadata, WithBoard):
         sigmas = self._convert_timesteps_to_sigmas(image_seq_len, torch.tensor(timesteps))
         total_steps = len(timesteps) - 1
 
-        # Prepare the CFG scale list.
+        # Build the per-step transformer timesteps and Euler step sizes on the device up front, so that the denoising
+        # loop does not have to transfer them from the CPU on every step.
+        # Timesteps are multiplied by 1000 to match the default FlowMatchEulerDiscreteScheduler num_train_timesteps.
+        transformer_timesteps = torch.tensor([t * 1000 for t in timesteps], device=device)
+        step_sizes = torch.tensor([sigmas[i + 1] - sigmas[i] for i in range(total_steps)], device=device)
+
+        # Prepare the CFG scale list. The list is used for per-step control flow, while the math uses a copy on the
+        # device so that the scale does not have to be transferred from the CPU on every step.
         cfg_scale = self._prepare_cfg_scale(total_steps)
+        cfg_scale_tensor = torch.tensor(cfg_scale, device=device)
 
         # Load the input latents, if provided.
         init_latents = context.tensors.load(self.latents.latents_name) if self.latents else None
@@ -294,52 +419,83 @@ class CogView4DenoiseInvocation(BaseInvocation, WithMetadata, WithBoard):
             ),
         )
 
-        with transformer_info.model_on_device() as (_, transformer):
+        with transformer_info.model_on_device() as (_, transformer), _allow_tf32(device):
             assert isinstance(transformer, CogView4Transformer2DModel)
 
+            run_transformer: Callable[..., Any] = transformer
+            # torch.compile's Inductor backend generates Triton kernels on CUDA. Triton is not installed on all
+            # platforms (e.g. Windows), so we fall back to eager mode if it is missing.
+            use_compiled_transformer = (
+                self.compile_transformer and device.type == "cuda" and importlib.util.find_spec("triton") is not None
+            )
+            if use_compiled_transformer:
+                run_transformer = functools.partial(self._get_compiled_transformer_forward(), transformer)
+            elif self.compile_transformer:
+                context.logger.warning(
+                    "torch.compile is only supported on CUDA devices with Triton installed. Running without compilation."
+                )
+
+            # When running batched CFG, pre-allocate the batched latent model input so that it is not re-allocated on
+            # every step. Otherwise, the latents are passed to the transformer directly.
+            latent_model_input = (
+                torch.empty((cfg_batch_size, *latents.shape[1:]), device=device, dtype=latents.dtype)
+                if batched_cfg
+                else None
+            )
+            cfg_euler_step = self._get_compiled_cfg_euler_step() if use_compiled_transformer else _cfg_euler_step
+
             # Denoising loop
             for step_idx in tqdm(range(total_steps)):
                 t_curr = timesteps[step_idx]
-                sigma_curr = sigmas[step_idx]
                 sigma_prev = sigmas[step_idx + 1]
 
-                # Expand the timestep to match the latent model input.
-                # Multiply by 1000 to match the default FlowMatchEulerDiscreteScheduler num_train_timesteps.
-                timestep = torch.tensor([t_curr * 1000], device=device).expand(latents.shape[0])
-
-                # TODO(ryand): Support both sequential and batched CFG inference.
-                noise_pred_cond = transformer(
-                    hidden_states=latents,
-                    encoder_hidden_states=pos_prompt_embeds,
-                    timestep=timestep,
-                    original_size=original_size,
-                    target_size=target_size,
-                    crop_coords=crops_coords_top_left,
-                    return_dict=False,
-                )[0]
-
-                # Apply CFG.
-                if do_classifier_free_guidance:
-                    noise_pred_uncond = transformer(
-                        hidden_states=latents,
-                        encoder_hidden_states=neg_prompt_embeds,
+                timestep = transformer_timesteps[step_idx].expand(cfg_batch_size)
+
+                # If the step's CFG scale is 1.0, then CFG reduces to the conditional prediction, so we don't need to
+                # run the unconditional prediction.
+                step_do_cfg = do_classifier_free_guidance and not math.isclose(cfg_scale[step_idx], 1.0)
+
+                if step_do_cfg and latent_model_input is not None:
+                    latent_model_input.copy_(latents.expand_as(latent_model_input))
+                    noise_pred_uncond, noise_pred_cond = run_transformer(
+                        hidden_states=latent_model_input,
+                        encoder_hidden_states=prompt_embeds,
                         timestep=timestep,
                         original_size=original_size,
                         target_size=target_size,
                         crop_coords=crops_coords_top_left,
                         return_dict=False,
+                    )[0].chunk(2)
+                else:
+                    # The conditioning inputs are sized for the CFG batch, so take the first (batch size 1) slice of each.
+                    noise_pred_cond = run_transformer(
+                        hidden_states=latents,
+                        encoder_hidden_states=pos_prompt_embeds,
+                        timestep=timestep[:1],
+                        original_size=original_size[:1],
+                        target_size=target_size[:1],
+                        crop_coords=crops_coords_top_left[:1],
+                        return_dict=False,
                     )[0]
 
-                    noise_pred = noise_pred_uncond + cfg_scale[step_idx] * (noise_pred_cond - noise_pred_uncond)
+                    if step_do_cfg:
+                        noise_pred_uncond = run_transformer(
+                            hidden_states=latents,
+                            encoder_hidden_states=neg_prompt_embeds,
+                            timestep=timestep,
+                            original_size=original_size,
+                            target_size=target_size,
+                            crop_coords=crops_coords_top_left,
+                            return_dict=False,
+                        )[0]
+
+                # Apply CFG (if enabled for this step) and compute the previous noisy sample x_t -> x_t-1.
+                if step_do_cfg:
+                    latents = cfg_euler_step(
+                        latents, noise_pred_uncond, noise_pred_cond, cfg_scale_tensor[step_idx], step_sizes[step_idx]
+                    )
                 else:
-                    noise_pred = noise_pred_cond
-
-                # Compute the previous noisy sample x_t -> x_t-1.
-                latents_dtype = latents.dtype
-                # TODO(ryand): Is casting to float32 necessary for precision/stability? I copied this from SD3.
-                latents = latents.to(dtype=torch.float32)
-                latents = latents + (sigma_prev - sigma_curr) * noise_pred
-                latents = latents.to(dtype=latents_dtype)
+                    latents = latents + step_sizes[step_idx] * noise_pred_cond
 
                 if inpaint_extension is not None:
                     latents = inpaint_extension.merge_intermediate_latents_with_init_latents(latents, sigma_prev)
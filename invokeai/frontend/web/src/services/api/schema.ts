@@ -3902,6 +3902,12 @@ export type components = {
              * @default 0
              */
             seed?: number;
+            /**
+             * Compile Transformer
+             * @description Compile the transformer with torch.compile (CUDA with Triton only). The model is compiled again for each new resolution and for each CFG mode (batched or sequential), so the first run of each is slow. Subsequent runs are faster.
+             * @default false
+             */
+            compile_transformer?: boolean;
             /**
              * type
              * @default cogview4_denoise
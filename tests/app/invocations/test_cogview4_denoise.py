@@ -0,0 +1,185 @@
+from typing import Any
+from unittest.mock import MagicMock
+
+import pytest
+import torch
+from diffusers.models.transformers.transformer_cogview4 import CogView4Transformer2DModel
+
+from invokeai.app.invocations.cogview4_denoise import CogView4DenoiseInvocation, _cfg_euler_step
+from invokeai.app.invocations.fields import CogView4ConditioningField
+from invokeai.backend.stable_diffusion.diffusion.conditioning_data import (
+    CogView4ConditioningInfo,
+    ConditioningFieldData,
+)
+from invokeai.backend.util.devices import TorchDevice
+
+
+def _build_invocation(**kwargs: Any) -> CogView4DenoiseInvocation:
+    # model_construct() skips validation, so we don't need a real transformer model identifier.
+    return CogView4DenoiseInvocation.model_construct(
+        positive_conditioning=CogView4ConditioningField(conditioning_name="pos"),
+        negative_conditioning=CogView4ConditioningField(conditioning_name="neg"),
+        **kwargs,
+    )
+
+
+def _build_context(pos_glm_embeds: torch.Tensor, neg_glm_embeds: torch.Tensor) -> MagicMock:
+    conditionings = {
+        "pos": ConditioningFieldData(conditionings=[CogView4ConditioningInfo(glm_embeds=pos_glm_embeds)]),
+        "neg": ConditioningFieldData(conditionings=[CogView4ConditioningInfo(glm_embeds=neg_glm_embeds)]),
+    }
+    context = MagicMock()
+    context.conditioning.load.side_effect = lambda name: conditionings[name]
+    return context
+
+
+def test_load_text_conditionings_same_shape():
+    pos_glm_embeds = torch.full((1, 16, 8), 1.0)
+    neg_glm_embeds = torch.full((1, 16, 8), 2.0)
+    context = _build_context(pos_glm_embeds, neg_glm_embeds)
+
+    pos, neg, batched = _build_invocation()._load_text_conditionings(
+        context, dtype=torch.bfloat16, device=torch.device("cpu")
+    )
+
+    assert batched is not None
+    assert batched.shape == (2, 16, 8)
+    assert batched.dtype == torch.bfloat16
+    # The batch is ordered [negative, positive].
+    assert torch.equal(batched[0:1], neg_glm_embeds.to(torch.bfloat16))
+    assert torch.equal(batched[1:2], pos_glm_embeds.to(torch.bfloat16))
+    assert torch.equal(pos, pos_glm_embeds.to(torch.bfloat16))
+    assert torch.equal(neg, neg_glm_embeds.to(torch.bfloat16))
+
+
+def test_load_text_conditionings_different_shapes():
+    pos_glm_embeds = torch.full((1, 16, 8), 1.0)
+    neg_glm_embeds = torch.full((1, 32, 8), 2.0)
+    context = _build_context(pos_glm_embeds, neg_glm_embeds)
+
+    pos, neg, batched = _build_invocation()._load_text_conditionings(
+        context, dtype=torch.bfloat16, device=torch.device("cpu")
+    )
+
+    assert batched is None
+    assert torch.equal(pos, pos_glm_embeds.to(torch.bfloat16))
+    assert torch.equal(neg, neg_glm_embeds.to(torch.bfloat16))
+
+
+@pytest.mark.parametrize("cfg_scale", [1.0, 3.5])
+def test_cfg_euler_step_matches_reference(cfg_scale: float):
+    generator = torch.Generator().manual_seed(0)
+    latents = torch.randn(1, 4, 8, 8, generator=generator)
+    noise_pred_uncond = torch.randn(1, 4, 8, 8, generator=generator)
+    noise_pred_cond = torch.randn(1, 4, 8, 8, generator=generator)
+    dt = -0.1
+
+    result = _cfg_euler_step(latents, noise_pred_uncond, noise_pred_cond, torch.tensor(cfg_scale), torch.tensor(dt))
+
+    noise_pred = noise_pred_uncond + cfg_scale * (noise_pred_cond - noise_pred_uncond)
+    expected = latents + dt * noise_pred
+    assert torch.allclose(result, expected)
+
+
+def test_cfg_euler_step_without_uncond_uses_cond():
+    generator = torch.Generator().manual_seed(0)
+    latents = torch.randn(1, 4, 8, 8, generator=generator)
+    noise_pred_cond = torch.randn(1, 4, 8, 8, generator=generator)
+    dt = torch.tensor(-0.1)
+
+    result = _cfg_euler_step(latents, noise_pred_cond, noise_pred_cond, torch.tensor(3.5), dt)
+
+    assert torch.equal(result, latents + dt * noise_pred_cond)
+
+
+def test_get_noise_is_reproducible():
+    noise = _build_invocation()._get_noise(
+        batch_size=1,
+        num_channels_latents=16,
+        height=256,
+        width=256,
+        dtype=torch.bfloat16,
+        device=torch.device("cpu"),
+        seed=123,
+    )
+
+    # Noise must match the original implementation: float16 noise generated on the CPU, then cast.
+    expected = torch.randn(
+        1, 16, 32, 32, device="cpu", dtype=torch.float16, generator=torch.Generator(device="cpu").manual_seed(123)
+    ).to(dtype=torch.bfloat16)
+    assert torch.equal(noise, expected)
+
+
+class _StubTransformer:
+    """Records the calls made to a stub CogView4 transformer.
+
+    The stub's prediction for each batch element only depends on that element's inputs, so running the CFG branches in
+    a single batch or sequentially must produce the same result.
+    """
+
+    def __init__(self):
+        self.calls: list[dict[str, Any]] = []
+        self.model = MagicMock(spec=CogView4Transformer2DModel)
+        self.model.config = MagicMock(patch_size=2, in_channels=4)
+        self.model.side_effect = self.forward
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        encoder_hidden_states: torch.Tensor,
+        timestep: torch.Tensor,
+        original_size: torch.Tensor,
+        target_size: torch.Tensor,
+        crop_coords: torch.Tensor,
+        return_dict: bool,
+    ) -> tuple[torch.Tensor]:
+        batch_size = hidden_states.shape[0]
+        for t in (encoder_hidden_states, timestep, original_size, target_size, crop_coords):
+            assert t.shape[0] == batch_size
+        self.calls.append({"batch_size": batch_size, "encoder_hidden_states": encoder_hidden_states})
+
+        cond = encoder_hidden_states.float().mean(dim=(1, 2)).view(-1, 1, 1, 1)
+        t = timestep.float().view(-1, 1, 1, 1) / 1000
+        size = (original_size + target_size + crop_coords).float().mean(dim=1).view(-1, 1, 1, 1) / 1000
+        return ((hidden_states.float() * 0.9 + cond + t + size).to(hidden_states.dtype),)
+
+
+def _run_diffusion(
+    monkeypatch: pytest.MonkeyPatch,
+    stub: _StubTransformer,
+    cfg_scale: float,
+    sequential_guidance: bool,
+) -> torch.Tensor:
+    monkeypatch.setattr(TorchDevice, "choose_torch_device", staticmethod(lambda: torch.device("cpu")))
+
+    context = _build_context(torch.full((1, 16, 8), 1.0), torch.full((1, 16, 8), -1.0))
+    context.config.get.return_value.sequential_guidance = sequential_guidance
+    transformer_info = MagicMock()
+    transformer_info.model = stub.model
+    transformer_info.model_on_device.return_value.__enter__.return_value = (None, stub.model)
+    context.models.load.return_value = transformer_info
+
+    invocation = _build_invocation(transformer=MagicMock(), cfg_scale=cfg_scale, width=64, height=64, steps=3, seed=0)
+    return invocation._run_diffusion(context)
+
+
+def test_run_diffusion_without_cfg_runs_conditional_pass_only(monkeypatch: pytest.MonkeyPatch):
+    stub = _StubTransformer()
+    latents = _run_diffusion(monkeypatch, stub, cfg_scale=1.0, sequential_guidance=False)
+
+    assert [c["batch_size"] for c in stub.calls] == [1, 1, 1]
+    # Only the positive conditioning is used.
+    assert all(torch.all(c["encoder_hidden_states"] == 1.0) for c in stub.calls)
+    assert latents.shape == (1, 4, 8, 8)
+    assert torch.isfinite(latents).all()
+
+
+def test_run_diffusion_batched_cfg_matches_sequential_cfg(monkeypatch: pytest.MonkeyPatch):
+    batched_stub = _StubTransformer()
+    batched_latents = _run_diffusion(monkeypatch, batched_stub, cfg_scale=3.5, sequential_guidance=False)
+    sequential_stub = _StubTransformer()
+    sequential_latents = _run_diffusion(monkeypatch, sequential_stub, cfg_scale=3.5, sequential_guidance=True)
+
+    assert [c["batch_size"] for c in batched_stub.calls] == [2, 2, 2]
+    assert [c["batch_size"] for c in sequential_stub.calls] == [1, 1, 1, 1, 1, 1]
+    assert torch.allclose(batched_latents.float(), sequential_latents.float(), rtol=1e-3, atol=1e-3)